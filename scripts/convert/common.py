@@ -1,7 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
 import subprocess
 import re
 import json
 import sys
+from functools import cached_property
+import threading
 from typing import Optional
 
 from loguru import logger
@@ -10,9 +15,14 @@ from pydantic import BaseModel, ConfigDict
 from pydantic.alias_generators import to_camel
 
 
+# Same escapes as `json.dumps(s, ensure_ascii=False)`
+_QUOTE_ESCAPES = str.maketrans(
+    {'"': '\\"', "\\": "\\\\"} | {chr(c): json.dumps(chr(c)).strip('"') for c in range(0x20)}
+)
+
 def _quote(s: str) -> str:
     """Quotes a string in double quotes."""
-    return json.dumps(s, ensure_ascii=False)
+    return '"' + s.translate(_QUOTE_ESCAPES) + '"'
 
 
 class BaseSchema(BaseModel):
@@ -31,17 +41,34 @@ class NodePart(BaseSchema):
     uses_raw: set[str]
     latex_env: str
 
-    def all_uses(self) -> list[str]:
-        return [use for use in self.uses] + [_quote(use) for use in self.uses_raw]
+    # The cached properties here and `Node.uses` are only valid once `parse_nodes` has finished
+    # converting `uses` and `uses_raw` in place, so they must not be read before that
+    @cached_property
+    def all_uses(self) -> tuple[str, ...]:
+        return (*self.uses, *(_quote(use) for use in self.uses_raw))
+
+    @cached_property
+    def uses_joined(self) -> str:
+        return ", ".join(self.uses)
+
+    @cached_property
+    def quoted_uses_raw(self) -> str:
+        return ", ".join(_quote(use) for use in self.uses_raw)
 
 def make_docstring(text: str, indent: int = 0) -> str:
     text = text.strip()
-    text = text.replace("\n", f"\n{' ' * indent}")
     if "\n" in text:
+        text = text.replace("\n", f"\n{' ' * indent}")
         return f"/--\n{' ' * indent}{text}\n{' ' * indent}-/"
     else:
         return f"/-- {text} -/"
 
+_BLUEPRINT_SLOTS = (
+    "title", "statement", "uses", "uses_raw", "proof", "proof_uses", "proof_uses_raw",
+    "not_ready", "discussion", "latex_env"
+)
+_BLUEPRINT_TEMPLATE = "blueprint" + "".join(f"{{{slot}}}" for slot in _BLUEPRINT_SLOTS)
+
 class Node(BaseSchema):
     name: str  # Lean identifier (unique)
     statement: NodePart
@@ -50,7 +77,7 @@ class Node(BaseSchema):
     discussion: Optional[int]
     title: Optional[str]
 
-    @property
+    @cached_property
     def uses(self) -> set[str]:
         return self.statement.uses | (self.proof.uses if self.proof is not None else set())
 
@@ -59,31 +86,31 @@ class Node(BaseSchema):
         add_statement_text: bool = True, add_uses: bool = True, add_uses_raw: bool = True,
         add_proof_text: bool = True, add_proof_uses: bool = True, add_proof_uses_raw: bool = True
     ) -> str:
-        configs = []
+        # Each slot is either empty or a config on a new line
         # See Architect/Attribute.lean for the options
+        slots = dict.fromkeys(_BLUEPRINT_SLOTS, "")
         if self.title:
-            configs.append(_quote(self.title))
+            slots["title"] = f"\n  {_quote(self.title)}"
         if add_statement_text and self.statement.text.strip():
-            configs.append(f"(statement := {make_docstring(self.statement.text, indent=2)})")
+            slots["statement"] = f"\n  (statement := {make_docstring(self.statement.text, indent=2)})"
         if add_uses and self.statement.uses:
-            configs.append(f"(uses := [{', '.join(self.statement.uses)}])")
+            slots["uses"] = f"\n  (uses := [{self.statement.uses_joined}])"
         if add_uses_raw and self.statement.uses_raw:
-            configs.append(f"(uses := [{', '.join(_quote(use) for use in self.statement.uses_raw)}])")
+            slots["uses_raw"] = f"\n  (uses := [{self.statement.quoted_uses_raw}])"
         if self.proof is not None:
             if add_proof_text and self.proof.text.strip():
-                configs.append(f"(proof := {make_docstring(self.proof.text, indent=2)})")
+                slots["proof"] = f"\n  (proof := {make_docstring(self.proof.text, indent=2)})"
             if add_proof_uses and self.proof.uses:
-                configs.append(f"(proofUses := [{', '.join(self.proof.uses)}])")
+                slots["proof_uses"] = f"\n  (proofUses := [{self.proof.uses_joined}])"
             if add_proof_uses_raw and self.proof.uses_raw:
-                configs.append(f"(proofUses := [{', '.join(_quote(use) for use in self.proof.uses_raw)}])")
+                slots["proof_uses_raw"] = f"\n  (proofUses := [{self.proof.quoted_uses_raw}])"
         if self.not_ready:
-            configs.append("(notReady := true)")
+            slots["not_ready"] = "\n  (notReady := true)"
         if self.discussion:
-            configs.append(f"(discussion := {self.discussion})")
+            slots["discussion"] = f"\n  (discussion := {self.discussion})"
         if self.proof is None and self.statement.latex_env != "definition" or self.proof is not None and self.statement.latex_env != "theorem":
-            configs.append(f"(latexEnv := {_quote(self.statement.latex_env)})")
-        config = "".join(f"\n  {config}" for config in configs)
-        return f"blueprint{config}"
+            slots["latex_env"] = f"\n  (latexEnv := {_quote(self.statement.latex_env)})"
+        return _BLUEPRINT_TEMPLATE.format_map(slots)
 
 class Position(BaseSchema):
     line: int
@@ -104,47 +131,117 @@ class NodeWithPos(Node):
 
 
 PANDOC_DEFAULT_WIDTH = 100
+# Inputs larger than this (in characters) are streamed to Pandoc in chunks
+PANDOC_STREAMING_THRESHOLD = 256 * 1024
+PANDOC_STREAMING_CHUNK_SIZE = 64 * 1024
 
-def pandoc_convert(from_format: str, to_format: str, input: str) -> str:
-    result = subprocess.run(
-        [
-            "pandoc", "-f", from_format, "-t", to_format,
-            f"--columns={PANDOC_DEFAULT_WIDTH}"
-        ],
-        check=True,
-        input=input,
-        stdout=subprocess.PIPE,
-        stderr=sys.stderr,
-        text=True,
-    )
-    return result.stdout
+def pandoc_convert(from_format: str, to_format: str, input: str, extra_args: tuple[str, ...] = ()) -> str:
+    args = [
+        "pandoc", "-f", from_format, "-t", to_format,
+        f"--columns={PANDOC_DEFAULT_WIDTH}", *extra_args
+    ]
+    if len(input) <= PANDOC_STREAMING_THRESHOLD:
+        result = subprocess.run(
+            args,
+            check=True,
+            input=input,
+            stdout=subprocess.PIPE,
+            stderr=sys.stderr,
+            text=True,
+        )
+        return result.stdout
 
-def pandoc_convert_latex_to_markdown(latex: str) -> str:
-    # Preprocess all citation commands to \cite
-    # From https://github.com/jgm/pandoc/blob/main/src/Text/Pandoc/Readers/LaTeX/Citation.hs
-    cite_commands = ["cite", "Cite", "citep", "citep*", "citeal", "citealp", "citealp*", "autocite", "smartcite", "footcite", "parencite", "supercite", "footcitetext", "citeyearpar", "citeyear", "autocite*", "cite*", "parencite*", "textcite", "citet", "citet*", "citealt", "citealt*", "textcites", "cites", "autocites", "footcites", "parencites", "supercites", "footcitetexts", "Autocite", "Smartcite", "Footcite", "Parencite", "Supercite", "Footcitetext", "Citeyearpar", "Citeyear", "Autocite*", "Cite*", "Parencite*", "Textcite", "Textcites", "Cites", "Autocites", "Footcites", "Parencites", "Supercites", "Footcitetexts", "citetext", "citeauthor", "nocite"]
-    latex = re.sub(
-        r"\\(?:" + "|".join(c.replace("*", r"\*") for c in cite_commands) + r")\s*(\[.*?\])?\s*\{(.*?)\}",
-        r"\\cite\1{\2}",
-        latex
-    )
+    # For large (batched) inputs, encode and write the input in chunks from another thread
+    # while Pandoc's output is read, instead of encoding the whole input up front
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+    assert proc.stdin is not None and proc.stdout is not None
 
-    # Call Pandoc to convert LaTeX to Markdown
-    converted = pandoc_convert(
-        "latex",
-        # Pandoc's Markdown flavor, disable raw HTML, disable attributes
-        "markdown-raw_html-raw_attribute-bracketed_spans-native_divs-native_spans-link_attributes",
-        latex
+    # Exceptions raised in the writer thread, re-raised in this thread
+    writer_errors: list[BaseException] = []
+
+    def write_input():
+        try:
+            with proc.stdin:
+                for i in range(0, len(input), PANDOC_STREAMING_CHUNK_SIZE):
+                    proc.stdin.write(input[i:i + PANDOC_STREAMING_CHUNK_SIZE].encode("utf-8"))
+        except BrokenPipeError:
+            pass  # Pandoc exited early; the error is reported by the return code below
+        except BaseException as e:
+            # Otherwise Pandoc would convert the truncated input and exit successfully
+            writer_errors.append(e)
+            proc.kill()
+
+    writer = threading.Thread(target=write_input)
+    writer.start()
+    try:
+        with io.TextIOWrapper(proc.stdout, encoding="utf-8") as stdout:
+            output = stdout.read()
+    except BaseException:
+        # Stop Pandoc, so that the writer is not left blocked on a full pipe
+        proc.kill()
+        raise
+    finally:
+        writer.join()
+        proc.wait()
+    if writer_errors:
+        raise writer_errors[0]
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+    return output
+
+# Pandoc's Markdown flavor, disable raw HTML, disable attributes
+PANDOC_MARKDOWN_FORMAT = "markdown-raw_html-raw_attribute-bracketed_spans-native_divs-native_spans-link_attributes"
+
+# A paragraph that Pandoc outputs unchanged, used to join several inputs into one Pandoc call
+PANDOC_BATCH_SEPARATOR = "LeanArchitectBatchSeparatorCD985272F78311"
+
+def pandoc_convert_batch(from_format: str, to_format: str, inputs: list[str]) -> list[str]:
+    """Converts a list of inputs using a single Pandoc call, by joining them with a separator paragraph.
+
+    Footnotes are placed after the block referencing them, so that they stay in the output of their own input.
+    """
+    if not inputs:
+        return []
+    output = pandoc_convert(
+        from_format, to_format, f"\n\n{PANDOC_BATCH_SEPARATOR}\n\n".join(inputs),
+        extra_args=("--reference-location=block",)
     )
+    outputs = output.split(PANDOC_BATCH_SEPARATOR)
+    if len(outputs) != len(inputs):
+        raise ValueError(f"Expected {len(inputs)} outputs from Pandoc but got {len(outputs)}")
+    return outputs
+
+# Citation commands, which are all preprocessed to \cite
+# From https://github.com/jgm/pandoc/blob/main/src/Text/Pandoc/Readers/LaTeX/Citation.hs
+_CITE_COMMANDS = ["cite", "Cite", "citep", "citep*", "citeal", "citealp", "citealp*", "autocite", "smartcite", "footcite", "parencite", "supercite", "footcitetext", "citeyearpar", "citeyear", "autocite*", "cite*", "parencite*", "textcite", "citet", "citet*", "citealt", "citealt*", "textcites", "cites", "autocites", "footcites", "parencites", "supercites", "footcitetexts", "Autocite", "Smartcite", "Footcite", "Parencite", "Supercite", "Footcitetext", "Citeyearpar", "Citeyear", "Autocite*", "Cite*", "Parencite*", "Textcite", "Textcites", "Cites", "Autocites", "Footcites", "Parencites", "Supercites", "Footcitetexts", "citetext", "citeauthor", "nocite"]
+_CITE_RE = re.compile(r"\\(?:" + "|".join(c.replace("*", r"\*") for c in _CITE_COMMANDS) + r")\s*(\[.*?\])?\s*\{(.*?)\}")
+# The \end and \ref postprocessing steps of Pandoc's Markdown output, combined in a single pattern (see `postprocess_markdown`)
+_POSTPROCESS_RE = re.compile(
+    r"(?P<end>(?<!\s)[^\S\n]*\n\s*\\end\s*\{(?P<end_env>.*?)\})"
+    r"|(?P<ref>\[\\\[(?P<ref_label>.*?)\\\]\]\(\#(?P=ref_label)\))"
+)
+# Citations in Pandoc's Markdown output, postprocessed after the \ref outputs that their text may contain
+_CITE_OUTPUT_RE = re.compile(r"\[((?:@[^\s;]+)(?:;\s*@[^\s;]+)*)(.*?)\]")
 
-    # Fix for pandoc bug: https://github.com/jgm/pandoc/issues/11257
-    # Remove paragraph breaks before \end.
-    converted = re.sub(r"\s*\n\s*\\end\s*\{(.*?)\}", r"\n\\end{\1}", converted)
+# Macro definitions, which would apply to all later inputs of a batched Pandoc call
+_MACRO_DEFINITION_RE = re.compile(
+    r"\\(?:(?:re)?newcommand|providecommand|DeclareMathOperator|(?:re)?newenvironment|[egx]?def|let)(?![a-zA-Z])"
+)
 
-    # Postprocess outputs of \ref commands
-    # Here, the \ref commands that refer to depgraph nodes were already replaced with \verb in parse_latex.py
-    # Pandoc converts the rest (e.g. \ref{chapter-label}) to [\[chapter-label\]](#chapter-label), which we convert back to \ref{chapter-label}
-    converted = re.sub(r"\[\\\[(.*?)\\\]\]\(\#\1\)", r"\\ref{\1}", converted)
+def preprocess_latex(latex: str) -> str:
+    return _CITE_RE.sub(r"\\cite\1{\2}", latex)
+
+def postprocess_markdown(converted: str) -> str:
+    def replace(match):
+        if match.group("end") is not None:
+            # Fix for pandoc bug: https://github.com/jgm/pandoc/issues/11257
+            # Remove paragraph breaks before \end.
+            return f"\n\\end{{{match.group('end_env')}}}"
+        else:
+            # Postprocess outputs of \ref commands
+            # Here, the \ref commands that refer to depgraph nodes were already replaced with \verb in parse_latex.py
+            # Pandoc converts the rest (e.g. \ref{chapter-label}) to [\[chapter-label\]](#chapter-label), which we convert back to \ref{chapter-label}
+            return f"\\ref{{{match.group('ref_label')}}}"
     # Postprocess citations: [@a; @b text] -> [a] [b], text
     def replace_cite(match):
         parts = match.group(1).split(";")
@@ -154,10 +251,48 @@ def pandoc_convert_latex_to_markdown(latex: str) -> str:
             return f"{tags}, {rest}"
         else:
             return tags
-    converted = re.sub(r"\[((?:@[^\s;]+)(?:;\s*@[^\s;]+)*)(.*?)\]", replace_cite, converted)
-    return converted.strip()
+    converted = _POSTPROCESS_RE.sub(replace, converted)
+    return _CITE_OUTPUT_RE.sub(replace_cite, converted)
+
+def pandoc_convert_latex_to_markdown(latex: str) -> str:
+    # Call Pandoc to convert LaTeX to Markdown
+    converted = pandoc_convert("latex", PANDOC_MARKDOWN_FORMAT, preprocess_latex(latex))
+    return postprocess_markdown(converted).strip()
 
 def convert_node_latex_to_markdown(node: Node):
     node.statement.text = pandoc_convert_latex_to_markdown(node.statement.text)
     if node.proof is not None:
         node.proof.text = pandoc_convert_latex_to_markdown(node.proof.text)
+
+def convert_nodes_latex_to_markdown_separately(nodes: list[Node]):
+    """Converts each node from LaTeX to Markdown with its own Pandoc calls, run in parallel."""
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(convert_node_latex_to_markdown, nodes))
+
+def convert_nodes_latex_to_markdown(nodes: list[Node]):
+    """Converts the statements and proofs of all nodes from LaTeX to Markdown, using a single Pandoc call.
+
+    If some node defines macros, or if the batched output cannot be split back into nodes
+    (e.g. because some node has unbalanced braces), falls back to converting each node separately.
+    """
+    if not nodes:
+        return
+    latex_sources: list[str] = []
+    for node in nodes:
+        latex_sources.append(node.statement.text)
+        latex_sources.append(node.proof.text if node.proof is not None else "")
+    if any(_MACRO_DEFINITION_RE.search(latex) for latex in latex_sources):
+        convert_nodes_latex_to_markdown_separately(nodes)
+        return
+    try:
+        outputs = pandoc_convert_batch(
+            "latex", PANDOC_MARKDOWN_FORMAT, [preprocess_latex(latex) for latex in latex_sources]
+        )
+    except ValueError as e:
+        logger.warning(f"{e}; converting nodes separately instead")
+        convert_nodes_latex_to_markdown_separately(nodes)
+        return
+    for i, node in enumerate(nodes):
+        node.statement.text = postprocess_markdown(outputs[2 * i]).strip()
+        if node.proof is not None:
+            node.proof.text = postprocess_markdown(outputs[2 * i + 1]).strip()
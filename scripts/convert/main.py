@@ -1,18 +1,22 @@
 import argparse
-import json
 import os
 from pathlib import Path
 import subprocess
 import sys
 
 from loguru import logger
+from pydantic import TypeAdapter
 
-from common import Node, NodeWithPos, convert_node_latex_to_markdown
+from common import Node, NodeWithPos, convert_nodes_latex_to_markdown
 from parse_latex import read_latex_file, parse_nodes, get_bibliography_files
 from modify_latex import write_latex_source
 from modify_lean import write_blueprint_attributes
 
 
+_NODES_ADAPTER = TypeAdapter(list[Node])
+_NODES_WITH_POS_ADAPTER = TypeAdapter(list[NodeWithPos])
+
+
 def main():
     parser = argparse.ArgumentParser(description="Convert existing leanblueprint file to lean-architect format.")
     parser.add_argument(
@@ -87,37 +91,31 @@ def main():
         nodes = [node for node in nodes if node.name in args.nodes]
 
     # Convert nodes to JSON
+    # (UTF-8 encoded bytes, which are passed to and read from the Lean script without decoding)
     logger.info("Converting nodes to JSON")
-    nodes_json = json.dumps(
-        [node.model_dump(mode="json", by_alias=True) for node in nodes],
-        ensure_ascii=False
-    )
+    nodes_json = _NODES_ADAPTER.dump_json(nodes, by_alias=True)
 
     # Add position information to nodes by passing to a Lean script
     logger.info("Adding position information to nodes using `lake exe add_position_info`")
     nodes_with_pos_json = subprocess.run(
         ["lake", "exe", "add_position_info", "--imports", ",".join(args.modules)],
         input=nodes_json,
-        text=True,
         check=True,
         stdout=subprocess.PIPE,
         stderr=sys.stderr,
     ).stdout
 
     if args.extract_only:
-        print(nodes_with_pos_json)
+        print(nodes_with_pos_json.decode("utf-8"))
         return
 
     # Parse the JSON into NodeWithPos
     logger.info("Parsing JSON into NodeWithPos")
-    nodes_with_pos = [
-        NodeWithPos.model_validate(node) for node in json.loads(nodes_with_pos_json)
-    ]
+    nodes_with_pos = _NODES_WITH_POS_ADAPTER.validate_json(nodes_with_pos_json)
 
     # Convert LaTeX to Markdown
     logger.info("Converting LaTeX to Markdown using Pandoc")
-    for node in nodes_with_pos:
-        convert_node_latex_to_markdown(node)
+    convert_nodes_latex_to_markdown(nodes_with_pos)
 
     # Write the blueprint attributes to Lean files
     logger.info("Writing @[blueprint] attributes to Lean files")
@@ -1,27 +1,60 @@
 """Utilities for adding @[blueprint] attributes to Lean source files."""
 
+import bisect
+import functools
+import itertools
 from pathlib import Path
 import re
-from typing import Optional
+from typing import Callable, Optional
 
 from loguru import logger
 
-from common import Node, NodeWithPos, Position, DeclarationRange, DeclarationLocation, make_docstring
+from common import Node, NodeWithPos, Position, make_docstring
 
 
-def split_declaration(source: str, pos: Position, end_pos: Position):
-    """Split a Lean file into pre, declaration, and post parts."""
-    lines = source.splitlines(keepends=True)
+def line_offsets(source: str) -> list[int]:
+    """Returns the offsets of the lines in a Lean file, so that `offsets[i]` is the start of line `i + 1`."""
+    return [0, *itertools.accumulate(len(line) for line in source.splitlines(keepends=True))]
 
-    # -1 because Lean Position is 1-indexed
-    start = sum(len(lines[i]) for i in range(pos.line - 1)) + pos.column
-    end = sum(len(lines[i]) for i in range(end_pos.line - 1)) + end_pos.column
-
-    pre = source[:start]
-    decl = source[start:end]
-    post = source[end:]
 
-    return pre, decl, post
+def declaration_span(offsets: list[int], pos: Position, end_pos: Position) -> tuple[int, int]:
+    """Returns the start and end of a declaration in a Lean file, given the line offsets of the file."""
+    # -1 because Lean Position is 1-indexed
+    start = offsets[pos.line - 1] + pos.column
+    end = offsets[end_pos.line - 1] + end_pos.column
+    return start, end
+
+
+# open ... in, omit ... in, include ... in, etc (assuming one-line, ending in newline, no interfering comments, etc)
+_CMD_MODIFIERS_RE = re.compile(r"(?:[a-zA-Z_].*?in\n)+")
+
+
+def split_leading_docstring(decl: str) -> tuple[Optional[str], str]:
+    """Splits a leading `/-- ... -/` docstring from the declaration, returning its content and the rest."""
+    stripped = decl.lstrip()
+    if not stripped.startswith("/--"):
+        return None, decl
+    end = stripped.find("-/", 3)
+    if end == -1:
+        return None, decl
+    return stripped[3:end], stripped[end + 2:].lstrip()
+
+
+def split_leading_attributes(decl: str) -> tuple[Optional[str], str]:
+    """Splits a leading `@[...]` attribute list from the declaration, returning its content and the rest."""
+    stripped = decl.lstrip()
+    if not stripped.startswith("@["):
+        return None, decl
+    # Find the matching closing bracket, allowing nested brackets inside the attributes
+    depth = 0
+    for i in range(1, len(stripped)):
+        if stripped[i] == "[":
+            depth += 1
+        elif stripped[i] == "]":
+            depth -= 1
+            if depth == 0:
+                return stripped[2:i], stripped[i + 1:].lstrip()
+    return None, decl
 
 
 warned_to_additive = False
@@ -33,25 +66,22 @@ def insert_docstring_and_attribute(decl: str, new_docstring: str, new_attr: str)
     and corner cases would be fixed manually.
     """
 
-    # open ... in, omit ... in, include ... in, etc (assuming one-line, ending in newline, no interfering comments, etc)
-    match = re.search(r"^(?:[a-zA-Z_]+.*?in\n)+", decl)
+    match = _CMD_MODIFIERS_RE.match(decl)
     if match:
         command_modifiers = match.group(0)
         decl = decl.removeprefix(match.group(0))
     else:
         command_modifiers = ""
 
-    match = re.search(r"^\s*/--(.*?)-/\s*", decl, flags=re.DOTALL)
-    if match:
-        docstring = f"{new_docstring}\n\n{match.group(1).strip()}"
-        decl = decl.removeprefix(match.group(0))
+    old_docstring, decl = split_leading_docstring(decl)
+    if old_docstring is not None:
+        docstring = f"{new_docstring}\n\n{old_docstring.strip()}"
     else:
         docstring = new_docstring
 
-    match = re.search(r"^\s*@\[(.*?)\]\s*", decl, flags=re.DOTALL)
-    if match:
-        attrs = match.group(1) + ", " + new_attr
-        decl = decl.removeprefix(match.group(0))
+    old_attrs, decl = split_leading_attributes(decl)
+    if old_attrs is not None:
+        attrs = old_attrs + ", " + new_attr
     else:
         attrs = new_attr
 
@@ -77,10 +107,8 @@ def insert_docstring_and_attribute(decl: str, new_docstring: str, new_attr: str)
     return f"{command_modifiers}{docstring}\n@[{attrs}]\n{decl}"
 
 
-def modify_source(node: Node, file: Path, location: DeclarationLocation, add_uses: bool, prepend: Optional[list[str]] = None):
-    """Modify a Lean source file to add @[blueprint] attribute and docstring to the node."""
-    source = file.read_text()
-    pre, decl, post = split_declaration(source, location.range.pos, location.range.end_pos)
+def modify_declaration(node: Node, decl: str, add_uses: bool, prepend: Optional[list[str]] = None) -> str:
+    """Modify the Lean source of a declaration to add @[blueprint] attribute and docstring to the node."""
     # If there needs to be raw `uses` added, or there is `sorry`, then the inferred dependencies are incomplete, so `uses` is needed
     add_uses = add_uses or (node.proof is None and "sorry" in decl)
     add_uses_raw = add_uses or len(node.statement.uses_raw) > 0
@@ -92,21 +120,53 @@ def modify_source(node: Node, file: Path, location: DeclarationLocation, add_use
     decl = insert_docstring_and_attribute(decl, new_docstring=node.statement.text, new_attr=attr)
     if prepend is not None:
         decl = "".join(p + "\n\n" for p in prepend) + decl
-    file.write_text(pre + decl + post)
+    return decl
+
+
+def apply_edits(source: str, start: int, end: int, edits: list[tuple[int, int, Callable[[str], str]]]) -> list[str]:
+    """Returns the segments of `source[start:end]`, with each (start, end) span in `edits` replaced by
+    its modification function applied to the span's source.
+
+    `edits` must be sorted by start and then by decreasing end. Spans nested inside another span
+    (e.g. the `to_additive` syntax of an additive declaration, which is inside the attributes of the
+    multiplicative declaration) are applied first, to the source of the outer span.
+    """
+    segments: list[str] = []
+    last_end = start
+    i = 0
+    while i < len(edits):
+        edit_start, edit_end, modify = edits[i]
+        inner: list[tuple[int, int, Callable[[str], str]]] = []
+        i += 1
+        while i < len(edits) and edits[i][0] < edit_end:
+            if edits[i][1] <= edit_end:
+                inner.append(edits[i])
+            else:
+                logger.warning(f"Skipping a declaration overlapping with another declaration at {edits[i][0]}-{edits[i][1]}")
+            i += 1
+        segments.append(source[last_end:edit_start])
+        segments.append(modify("".join(apply_edits(source, edit_start, edit_end, inner))))
+        last_end = edit_end
+    segments.append(source[last_end:end])
+    return segments
 
 
-def add_blueprint_gen_import(file: Path):
-    """Adds `import Architect` before the first import in the file."""
-    source = file.read_text()
-    lines = source.splitlines(keepends=True)
-    first_import_index = 0
-    for i, line in enumerate(lines):
-        if line.startswith("import ") or line.startswith("public import "):
-            first_import_index = i
-            break
-    lines = lines[:first_import_index] + ["import Architect\n"] + lines[first_import_index:]
-    source = "".join(lines)
-    file.write_text(source)
+_IMPORT_RE = re.compile(r"^(?:public )?import ", flags=re.MULTILINE)
+
+def write_modified_source(file: Path, source: str, edits: list[tuple[int, int, Callable[[str], str]]]):
+    """Writes the Lean source to the file, replacing the (start, end) spans in `edits` with their modifications
+    (see `apply_edits`) and adding `import Architect` before the first import.
+
+    The unchanged parts and the new declarations are written as separate segments,
+    so that the modified file is never built as a whole in memory.
+    """
+    match = _IMPORT_RE.search(source)
+    first_import_start = match.start() if match else 0
+    edits = sorted(edits, key=lambda edit: (edit[0], -edit[1]))
+    segments = [source[:first_import_start], "import Architect\n"]
+    segments.extend(apply_edits(source, first_import_start, len(source), edits))
+    with file.open("w") as f:
+        f.writelines(segments)
 
 
 def topological_sort(data: list[tuple[NodeWithPos, str]]) -> list[tuple[NodeWithPos, str]]:
@@ -115,31 +175,27 @@ def topological_sort(data: list[tuple[NodeWithPos, str]]) -> list[tuple[NodeWith
     visited: set[str] = set()
     result: list[tuple[NodeWithPos, str]] = []
 
-    def visit(name: str):
-        if name in visited:
-            return
-        visited.add(name)
-
-        node, value = name_to_node[name]
-        for used in node.uses:
-            if used in name_to_node:
-                visit(used)
-        result.append((node, value))
-
-    for node, _ in data:
-        visit(node.name)
+    # Iterative depth-first search, where each stack entry is a node and an iterator over its remaining uses
+    for root, _ in data:
+        if root.name in visited:
+            continue
+        visited.add(root.name)
+        stack = [(root.name, iter(name_to_node[root.name][0].uses))]
+        while stack:
+            name, uses = stack[-1]
+            for used in uses:
+                if used in name_to_node and used not in visited:
+                    visited.add(used)
+                    stack.append((used, iter(name_to_node[used][0].uses)))
+                    break
+            else:
+                stack.pop()
+                result.append(name_to_node[name])
 
     return result
 
 
 def write_blueprint_attributes(nodes: list[NodeWithPos], modules: list[str], root_file: str, convert_informal: bool, add_uses: bool):
-    # Sort nodes by reverse position, so that we can modify later declarations first
-    nodes_location_order = sorted(
-        nodes,
-        key=lambda n:
-            (n.location.module, n.location.range.pos.line) if n.location is not None else ("", 0),
-        reverse=True
-    )
     nodes_topological_order = [n for n, _ in topological_sort([(n, "") for n in nodes])]
 
     # For upstream nodes and informal-only nodes, they are rendered as `attribute [blueprint] node_name` and
@@ -153,49 +209,63 @@ def write_blueprint_attributes(nodes: list[NodeWithPos], modules: list[str], roo
     # containing (1) upstream nodes and (2) informal-only nodes,
     # that are not directly used by any normal node in the blueprint
     extra_nodes: list[str] = []
+    module_prefixes = set(modules)
     def is_upstream_or_informal(node: NodeWithPos) -> bool:
-        return node.location is None or not any(node.location.module.split(".")[0] == module for module in modules)
+        return node.location is None or node.location.module.partition(".")[0] not in module_prefixes
     def upstream_or_informal_to_lean(node: NodeWithPos) -> str:
         if node.location is not None:
             return f"attribute [{node.to_lean_attribute()}] {node.name}"
         else:
-            lean = ""
+            parts: list[str] = []
             if node.statement.text.strip():
-                lean += f"{make_docstring(node.statement.text)}\n"
-            lean += f"@[{node.to_lean_attribute(add_statement_text=False, add_uses=False, add_proof_text=False, add_proof_uses=False)}]\n"
+                parts.append(f"{make_docstring(node.statement.text)}\n")
+            parts.append(f"@[{node.to_lean_attribute(add_statement_text=False, add_uses=False, add_proof_text=False, add_proof_uses=False)}]\n")
             if node.proof is None:
-                lean += f"def {node.name} : (sorry : Type) :=\n"
-                lean += f"  sorry_using [{', '.join(node.statement.all_uses())}]"
+                parts.append(f"def {node.name} : (sorry : Type) :=\n")
+                parts.append(f"  sorry_using [{', '.join(node.statement.all_uses)}]")
             else:
-                lean += f"theorem {node.name} : (sorry_using [{', '.join(node.proof.all_uses())}] : Prop) := by\n"
+                parts.append(f"theorem {node.name} : (sorry_using [{', '.join(node.proof.all_uses)}] : Prop) := by\n")
                 if node.proof.text.strip():
-                    lean += f"  {make_docstring(node.proof.text, indent=2)}\n"
-                lean += f"  sorry_using [{', '.join(node.statement.all_uses())}]"
-            return lean
-    for node in nodes_topological_order:
+                    parts.append(f"  {make_docstring(node.proof.text, indent=2)}\n")
+                parts.append(f"  sorry_using [{', '.join(node.statement.all_uses)}]")
+            return "".join(parts)
+    # Mapping from each node name to the (increasing) topological indices of the normal nodes that use it
+    dependent_indices: dict[str, list[int]] = {}
+    for i, node in enumerate(nodes_topological_order):
+        if not is_upstream_or_informal(node):
+            for used in node.uses:
+                dependent_indices.setdefault(used, []).append(i)
+    for i, node in enumerate(nodes_topological_order):
         if is_upstream_or_informal(node):
-            for normal_node in nodes_topological_order[nodes_topological_order.index(node):]:
-                if not is_upstream_or_informal(normal_node) and node.name in normal_node.uses:
-                    prepends[normal_node.name].append(upstream_or_informal_to_lean(node))
-                    break
+            # The first normal node using this node that comes after it in topological order
+            indices = dependent_indices.get(node.name, [])
+            j = bisect.bisect_left(indices, i)
+            if j < len(indices):
+                prepends[nodes_topological_order[indices[j]].name].append(upstream_or_informal_to_lean(node))
             else:
                 extra_nodes.append(upstream_or_informal_to_lean(node))
 
     # Main loop for adding @[blueprint] attributes to nodes
-    modified_files: set[str] = set()
+    # The sources of modified files are read once, and the edits to each file are written at the end.
+    modified_sources: dict[Path, str] = {}
+    modified_offsets: dict[Path, list[int]] = {}
+    edits: dict[Path, list[tuple[int, int, Callable[[str], str]]]] = {}
 
-    for node in nodes_location_order:
+    for node in nodes:
         if is_upstream_or_informal(node):
             continue
         assert node.has_lean and node.file is not None and node.location is not None
-        modify_source(
-            node, Path(node.file), node.location, add_uses=add_uses,
-            prepend=prepends[node.name]
-        )
-        modified_files.add(node.file)
-
-    for file in modified_files:
-        add_blueprint_gen_import(Path(file))
+        file = Path(node.file)
+        if file not in modified_sources:
+            modified_sources[file] = file.read_text()
+            modified_offsets[file] = line_offsets(modified_sources[file])
+            edits[file] = []
+        start, end = declaration_span(modified_offsets[file], node.location.range.pos, node.location.range.end_pos)
+        modify = functools.partial(modify_declaration, node, add_uses=add_uses, prepend=prepends[node.name])
+        edits[file].append((start, end, modify))
+
+    for file, source in modified_sources.items():
+        write_modified_source(file, source, edits[file])
 
     # Write extra nodes to the root file
     if extra_nodes:
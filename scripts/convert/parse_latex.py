@@ -1,55 +1,130 @@
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+import io
+import itertools
 import uuid
 from pathlib import Path
 import re
 from dataclasses import dataclass
-from typing import Optional
+from typing import Container, Literal, Optional, Union
+import functools
 
 from loguru import logger
 
 from common import Node, NodePart, _quote
 
 
+_INPUT_RE = re.compile(r"\\input\s*\{([^\}]*)\}")
+_NBSP_RE = re.compile(r"(?<!\\)~")
+_USEPACKAGE_THMS_RE = re.compile(r"\\usepackage\s*\[[^\]]*\bthms\s*=\s*([^,\]\}]*)")
+# Separator of comma-separated command arguments, e.g. in \uses{a, b}
+_COMMA_SPLIT_RE = re.compile(r"\s*,\s*")
+_BIBLIOGRAPHY_RE = re.compile(r"\\bibliography\s*\{([^\}]*)\}")
+_BEGIN_END_RE = re.compile(r"\\(begin|end)\s*\{([^\}]+)\}")
+# From https://github.com/jgm/pandoc/blob/main/src/Text/Pandoc/Readers/LaTeX/Inline.hs
+_REF_COMMANDS = ["ref", "cref", "Cref", "vref", "eqref", "autoref"]
+_REF_RE = re.compile(r"\\(?:" + "|".join(_REF_COMMANDS) + r")\s*\{([^\}]*)\}")
+
+
+def read_text(file: Path) -> str:
+    """Read a UTF-8 text file as a whole, translating newlines like `Path.read_text`."""
+    text = file.read_bytes().decode("utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return text
+
+
+def read_text_if_exists(file: Path) -> Optional[str]:
+    """Like `read_text`, but returns None if the file does not exist (without a separate `stat` call)."""
+    try:
+        return read_text(file)
+    except FileNotFoundError:
+        return None
+
+
+# Number of threads used for reading the included LaTeX files
+READ_WORKERS = 8
+
 def read_latex_file(file: Path) -> str:
     """Read the LaTeX file at `file`, recursively resolving and inlining any `\\input{...}` commands."""
     root_dir = file.parent
-    def _read(file: Path, seen: set[Path]) -> str:
+    def input_file(match: re.Match[str]) -> Path:
+        input_path = match.group(1).strip()
+        if not input_path.endswith(".tex"):
+            input_path += ".tex"
+        return root_dir / input_path
+
+    # Read all transitively included files, level by level, with the files of each level read concurrently
+    # Each file is read at most once, and files that do not exist are not in `texts`
+    texts: dict[Path, str] = {file: read_text(file)}
+    inputs: dict[Path, list[tuple[re.Match[str], Path]]] = {}
+    attempted: set[Path] = {file}
+    level = [file]
+    with ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        while level:
+            for level_file in level:
+                inputs[level_file] = [(match, input_file(match)) for match in _INPUT_RE.finditer(texts[level_file])]
+            next_level = list(dict.fromkeys(
+                included for level_file in level for _, included in inputs[level_file]
+                if included not in attempted
+            ))
+            attempted.update(next_level)
+            level = []
+            for next_file, text in zip(next_level, executor.map(read_text_if_exists, next_level)):
+                if text is not None:
+                    texts[next_file] = text
+                    level.append(next_file)
+
+    # Then inline the files into a single buffer rather than by nested substitutions
+    buffer = io.StringIO()
+    def _read(file: Path, seen: set[Path]):
         if file in seen:
             logger.warning(f"Circular \\input detected for file: {file}")
-            return ""
+            return
         seen.add(file)
-        text = file.read_text()
-        def replace_input(match):
-            input_path = match.group(1).strip()
-            if not input_path.endswith(".tex"):
-                input_path += ".tex"
-            input_file : Path = root_dir / input_path
-            if not input_file.exists():
-                logger.warning(f"\\input file not found: {input_file}")
-                return ""
-            return _read(input_file, seen)
-        text = re.sub(r"\\input\s*\{([^\}]*)\}", replace_input, text)
-        return text
-    return _read(file, set())
-
-
-def find_and_remove_command(command: str, source: str) -> tuple[bool, str]:
-    match = re.search(r"\\" + command + r"\b", source)
-    source = re.sub(r"\\" + command + r"\b", "", source)
-    return match is not None, source
-
-
-def find_and_remove_command_arguments(command: str, source: str, sub_count: int = 0) -> tuple[list[str], str]:
-    matches = re.findall(r"\\" + command + r"\s*\{([^\}]*)\}", source)
-    values = [item.strip() for m in matches for item in m.split(",")]
-    source = re.sub(r"\\" + command + r"\s*\{[^\}]*\}", "", source, count=sub_count)
-    return values, source
-
-
-def find_and_remove_command_argument(command: str, source: str) -> tuple[Optional[str], str]:
-    args, source = find_and_remove_command_arguments(command, source, sub_count=1)
+        text = texts[file]
+        last_end = 0
+        for match, included in inputs[file]:
+            buffer.write(text[last_end:match.start()])
+            last_end = match.end()
+            if included not in texts:
+                logger.warning(f"\\input file not found: {included}")
+                continue
+            _read(included, seen)
+        buffer.write(text[last_end:])
+    _read(file, set())
+    return buffer.getvalue()
+
+
+def environment_spans(source: str) -> list[tuple[int, int]]:
+    """Returns the sorted spans of the outermost environments in `source`,
+    by matching `\\begin` and `\\end` with a stack in a single pass."""
+    stack: list[tuple[str, int]] = []
+    spans: list[tuple[int, int]] = []
+    for match in _BEGIN_END_RE.finditer(source):
+        kind, env = match.groups()
+        if kind == "begin":
+            stack.append((env, match.start()))
+        elif any(begin_env == env for begin_env, _ in stack):
+            # Pop up to the matching \begin, dropping any unclosed environments inside it
+            while True:
+                begin_env, start = stack.pop()
+                if begin_env == env:
+                    break
+            spans.append((start, match.end()))
+    # Keep only the outermost spans (inner environments are closed, and thus appended, before outer ones)
+    spans.sort()
+    outermost: list[tuple[int, int]] = []
+    for start, end in spans:
+        if not outermost or start >= outermost[-1][1]:
+            outermost.append((start, end))
+    return outermost
+
+
+def first_argument(command: str, args: list[str]) -> Optional[str]:
     if len(args) > 1:
         logger.warning(f"Multiple \\{command} arguments found: {', '.join(args)}; only using the first one.")
-    return args[0] if args else None, source
+    return args[0] if args else None
 
 
 @dataclass
@@ -63,38 +138,74 @@ class SourceInfo:
     mathlibok: bool
     lean: Optional[str]
     discussion: Optional[int]
+    has_refs: bool  # whether the source contains \ref commands, to be converted by `convert_ref_to_verb`
+
+
+# Custom commands (\label, plastexdepgraph, leanblueprint commands), parsed in a single pass
+# together with \ref commands, which are only detected here
+_BLUEPRINT_COMMAND_RE = re.compile(
+    r"\\(label|uses|alsoIn|proves|lean|discussion)\s*\{([^\}]*)\}|\\(leanok|notready|mathlibok)\b"
+    r"|\\(" + "|".join(_REF_COMMANDS) + r")\s*\{[^\}]*\}"
+)
+# Commands for which all occurrences are removed; for the other commands with arguments, only the first one is used and removed
+_MULTIPLE_ARGUMENT_COMMANDS = {"uses", "alsoIn"}
 
 
 def parse_and_remove_blueprint_commands(source: str) -> tuple[SourceInfo, str]:
     """Parse and remove custom commands (\\label, plastexdepgraph, leanblueprint commands)."""
-    # \label
+    if "\\" not in source:
+        return SourceInfo(
+            label=None, uses=[], alsoIn=[], proves=None, leanok=False, notready=False, mathlibok=False,
+            lean=None, discussion=None, has_refs=False
+        ), source.strip()
     # We only look for \label in the outermost environment because inner environments may have their own labels.
-    def remove_environments(source: str) -> str:
-        # Note: this is only approximate, e.g. it does not handle nested same environments correctly
-        return re.sub(r"\\begin\s*\{(.*?)\}.*?\\end\s*\{\1\}", r"", source, flags=re.DOTALL)
-    label, _ = find_and_remove_command_argument("label", remove_environments(source))
-    source = source.replace(f"\\label{{{label}}}", "")  # remove \label from source manually
-    # plastexdepgraph commands
-    uses, source = find_and_remove_command_arguments("uses", source)
-    alsoIn, source = find_and_remove_command_arguments("alsoIn", source)
-    proves, source = find_and_remove_command_argument("proves", source)
-    # leanblueprint commands
-    leanok, source = find_and_remove_command("leanok", source)
-    notready, source = find_and_remove_command("notready", source)
-    mathlibok, source = find_and_remove_command("mathlibok", source)
-    lean, source = find_and_remove_command_argument("lean", source)
-    discussion, source = find_and_remove_command_argument("discussion", source)
+    # The environment spans are only computed once a \label is found in a source with inner environments.
+    original_source = source
+    spans: Optional[list[tuple[int, int]]] = None
+    span_starts: list[int] = []
+    def in_environment(pos: int) -> bool:
+        nonlocal spans, span_starts
+        if spans is None:
+            spans = environment_spans(original_source) if "\\begin" in original_source else []
+            span_starts = [start for start, _ in spans]
+        i = bisect.bisect_right(span_starts, pos) - 1
+        return i >= 0 and pos < spans[i][1]
+
+    args: dict[str, list[str]] = {command: [] for command in ["label", "uses", "alsoIn", "proves", "lean", "discussion"]}
+    flags: set[str] = set()
+    has_refs = False
+    def replace_command(match):
+        nonlocal has_refs
+        command, arg, flag, ref = match.groups()
+        if ref is not None:
+            has_refs = True
+            return match.group(0)
+        if flag is not None:
+            flags.add(flag)
+            return ""
+        if command == "label" and in_environment(match.start()):
+            return match.group(0)
+        remove = command in _MULTIPLE_ARGUMENT_COMMANDS or not args[command]
+        args[command].extend(item for item in _COMMA_SPLIT_RE.split(arg.strip()) if item)
+        return "" if remove else match.group(0)
+    source = _BLUEPRINT_COMMAND_RE.sub(replace_command, source)
+
+    label = first_argument("label", args["label"])
+    proves = first_argument("proves", args["proves"])
+    lean = first_argument("lean", args["lean"])
+    discussion = first_argument("discussion", args["discussion"])
     source = source.strip()
     return SourceInfo(
         label=label,
-        uses=uses,
-        alsoIn=alsoIn,
+        uses=args["uses"],
+        alsoIn=args["alsoIn"],
         proves=proves,
-        leanok=leanok,
-        notready=notready,
-        mathlibok=mathlibok,
+        leanok="leanok" in flags,
+        notready="notready" in flags,
+        mathlibok="mathlibok" in flags,
         lean=lean,
-        discussion=try_int(discussion)
+        discussion=try_int(discussion),
+        has_refs=has_refs
     ), source
 
 
@@ -107,7 +218,7 @@ def try_int(s: Optional[str]) -> Optional[int]:
         return None
 
 
-def convert_ref_to_verb(source: str, label_to_node: dict[str, Node]):
+def convert_ref_to_verb(source: str, label_to_name: dict[str, str]):
     r"""Convert \ref{latex-label-of-node} to \verb{lean_name_of_node} if possible,
     as a preprocessing step for converting to Markdown.
 
@@ -115,44 +226,51 @@ def convert_ref_to_verb(source: str, label_to_node: dict[str, Node]):
     `long_theorem_name` instead, and the latter can be automatically converted to
     links/refs by both doc-gen4 and lean-architect.
     """
+    if "\\" not in source:
+        return source.strip()
+    get_name = label_to_name.get
+    verb = "\\verb|%s|".__mod__
+    ref = "\\ref{%s}".__mod__
     def replace_ref(match):
         labels = [label.strip() for label in match.group(1).split(",")]
         output = []
         for label in labels:
-            if label in label_to_node:
+            name = get_name(label)
+            if name is not None:
                 # Note: using \verb instead of \texttt because Pandoc would e.g. process the
                 # braces and quotes in \texttt.
-                output.append(f"\\verb|{label_to_node[label].name}|")
+                output.append(verb(name))
             elif "_" in label:
                 # If the label contains an underscore (e.g. \label{sec_label}), we assume it is still a Lean name and wrap it in \verb,
                 # even though it is not in the blueprint graph. This is then converted to `sec_label` instead of \ref{sec_label}, which
                 # avoids errors with escaping the underscore in later conversion from Markdown to LaTeX.
-                output.append(f"\\verb|{label}|")
+                output.append(verb(label))
             else:
                 # Retain the use of \ref
-                output.append(f"\\ref{{{label}}}")
+                output.append(ref(label))
         return ", ".join(output)
-    # From https://github.com/jgm/pandoc/blob/main/src/Text/Pandoc/Readers/LaTeX/Inline.hs
-    ref_commands = ["ref", "cref", "Cref", "vref", "eqref", "autoref"]
-    source = re.sub(r"\\(?:" + "|".join(ref_commands) + r")\s*\{([^\}]*)\}", replace_ref, source)
+    source = _REF_RE.sub(replace_ref, source)
     source = source.strip()
     return source
 
 
-def convert_latex_label_to_lean_name(node_part: NodePart, label_to_node: dict[str, Node]):
-    """Converts the `uses` and `\\ref` commands to reference Lean names rather than LaTeX labels."""
-    for use in list(node_part.uses_raw):
-        # Convert from LaTeX labels in uses_raw to Lean names in uses, if the used node is formalized.
-        # Otherwise, keep the LaTeX label in uses_raw.
-        if use in label_to_node:
-            used_node = label_to_node[use]
-            node_part.uses_raw.remove(use)
-            node_part.uses.add(used_node.name)
-    node_part.text = convert_ref_to_verb(node_part.text, label_to_node)
+def convert_latex_label_to_lean_name(node_part: NodePart, label_to_name: dict[str, str], has_refs: bool = True):
+    """Converts the `uses` and `\\ref` commands to reference Lean names rather than LaTeX labels.
+
+    If `has_refs` is false, the text is known to contain no `\\ref` commands and is not scanned again.
+    """
+    # Convert from LaTeX labels in uses_raw to Lean names in uses, if the used node is formalized.
+    # Otherwise, keep the LaTeX label in uses_raw.
+    matched = node_part.uses_raw & label_to_name.keys()
+    node_part.uses.update(label_to_name[use] for use in matched)
+    node_part.uses_raw -= matched
+    if has_refs:
+        node_part.text = convert_ref_to_verb(node_part.text, label_to_name)
 
 
 def remove_nonbreaking_spaces(source: str) -> str:
-    source = re.sub(r"(?<!\\)~", r" ", source)
+    if "~" in source:
+        source = _NBSP_RE.sub(" ", source)
     source = source.strip()
     return source
 
@@ -164,7 +282,7 @@ def process_source(source: str) -> tuple[SourceInfo, str]:
 
 
 # NB: this is not used if --convert_informal is not set
-def generate_new_lean_name(visited_names: set[str], base: Optional[str]) -> str:
+def generate_new_lean_name(visited_names: Container[str], base: Optional[str]) -> str:
     """Generate a unique Lean identifier."""
     if base is None:
         base = f"node_{uuid.uuid4().hex}"
@@ -174,24 +292,84 @@ def generate_new_lean_name(visited_names: set[str], base: Optional[str]) -> str:
             base = "_" + base
     if base not in visited_names:
         return base
-    return generate_new_lean_name(visited_names, f"{base}_{uuid.uuid4().hex}")
+    for i in itertools.count(2):
+        name = f"{base}_{i}"
+        if name not in visited_names:
+            return name
+
+
+@functools.lru_cache(maxsize=8)
+def environment_begin_pattern(envs: tuple[str, ...]) -> re.Pattern[str]:
+    """Returns the compiled pattern of `\\begin{env}` for any of `envs`."""
+    return re.compile(r"\\begin\s*\{(" + "|".join(envs) + r")\}\s*")
+
+
+_TITLE_RE = re.compile(r"\[(.*?)\]", re.DOTALL)
+
+
+@functools.lru_cache(maxsize=None)
+def environment_end_pattern(env: str) -> re.Pattern[str]:
+    """Returns the compiled pattern of `\\end{env}`."""
+    return re.compile(r"\\end\s*\{" + re.escape(env) + r"\}")
+
+
+@dataclass
+class Environment:
+    env: str
+    title: Optional[str]
+    content: str
+    start: int
+    end: int
+
+
+def find_environments(source: str, envs: tuple[str, ...]) -> list[Environment]:
+    """Finds the non-overlapping environments in `source` of any of `envs`,
+    each ending at the first matching `\\end` after its `\\begin`."""
+    begin_pattern = environment_begin_pattern(envs)
+    # Environments with no `\end` after the current position (and thus none after any later position)
+    unclosed: set[str] = set()
+    environments: list[Environment] = []
+    pos = 0
+    while (begin := begin_pattern.search(source, pos)) is not None:
+        env = begin.group(1)
+        end_pattern = environment_end_pattern(env)
+        end = None if env in unclosed else end_pattern.search(source, begin.end())
+        if end is None:
+            unclosed.add(env)
+            pos = begin.start() + 1
+            continue
+        # The optional [title] is taken if it is followed by an `\end`
+        title = _TITLE_RE.match(source, begin.end())
+        if title is not None and (title_end := end_pattern.search(source, title.end())) is not None:
+            content_start, end = title.end(), title_end
+        else:
+            title, content_start = None, begin.end()
+        environments.append(Environment(
+            env, title and title.group(1), source[content_start:end.start()], begin.start(), end.end()
+        ))
+        pos = end.end()
+    return environments
+
+
+def is_commented_out(source: str, pos: int) -> bool:
+    """Whether there is a `%` between the start of the line and `pos`."""
+    line_start = source.rfind("\n", 0, pos) + 1
+    return source.find("%", line_start, pos) != -1
 
 
 def parse_nodes(source: str, convert_informal: bool) -> tuple[list[Node], dict[str, list[str]], dict[str, Node]]:
     """Parse the nodes in the LaTeX source."""
-    match = re.search(r"\\usepackage\s*\[[^\]]*\bthms\s*=\s*([^,\]\}]*)", source)
+    match = _USEPACKAGE_THMS_RE.search(source)
     if match:
         depgraph_thm_types = match.group(1).strip().split("+")
     else:
         depgraph_thm_types = "definition+lemma+proposition+theorem+corollary".split("+")
 
-    ENV_PATTERN = re.compile(
-        r"\\begin\s*\{(" + "|".join(depgraph_thm_types + ["proof"]) + r")\}\s*(?:\[(.*?)\])?(.*?)\\end\s*\{\1\}",
-        re.DOTALL
-    )
+    environments = find_environments(source, tuple(depgraph_thm_types + ["proof"]))
 
-    # Maps matches[i] to node, or None if the node is not in Lean and convert_informal is False
-    match_idx_to_node: dict[int, Optional[Node]] = {}
+    # Maps environments[i] to node, or None if the node is not in Lean and convert_informal is False,
+    # or False if environments[i] is not a parsed statement
+    match_idx_to_node: list[Union[Node, None, Literal[False]]] = [False] * len(environments)
 
     # Parsed nodes
     nodes: list[Node] = []
@@ -201,17 +379,25 @@ def parse_nodes(source: str, convert_informal: bool) -> tuple[list[Node], dict[s
     # Raw sources of each name, for modifying LaTeX later
     name_to_raw_sources: dict[str, list[str]] = {}
 
+    # Parsed node parts, and whether their text contains \ref commands
+    parts: list[tuple[NodePart, bool]] = []
+
+    # Proof environments, which are parsed after all statements
+    proof_environments: list[tuple[int, Environment]] = []
+
     # Parse all theorem and definition statements
-    for i, match in enumerate(ENV_PATTERN.finditer(source)):
-        env, title, content = match.groups()
+    for i, environment in enumerate(environments):
+        env = environment.env
 
+        if env == "proof":
+            proof_environments.append((i, environment))
         if env not in depgraph_thm_types:
             continue
-        # Skip if match is commented out
-        if "%" in source[:match.span()[0]].split("\n")[-1].strip():
+        # Skip if environment is commented out
+        if is_commented_out(source, environment.start):
             continue
 
-        source_info, node_source = process_source(content)
+        source_info, node_source = process_source(environment.content)
         if source_info.lean is not None:
             name = source_info.lean
             if source_info.label is None:
@@ -220,8 +406,8 @@ def parse_nodes(source: str, convert_informal: bool) -> tuple[list[Node], dict[s
             match_idx_to_node[i] = None
             continue
         else:
-            name = generate_new_lean_name(set(name_to_node.keys()), source_info.label)
-        name_to_raw_sources.setdefault(name, []).append(match.group(0))
+            name = generate_new_lean_name(name_to_node, source_info.label)
+        name_to_raw_sources.setdefault(name, []).append(source[environment.start:environment.end])
 
         if name in name_to_node:
             logger.warning(f"Lean name {_quote(name)} occurs in blueprint multiple times; only keeping the first.")
@@ -232,7 +418,8 @@ def parse_nodes(source: str, convert_informal: bool) -> tuple[list[Node], dict[s
                 uses=set(), uses_raw=set(source_info.uses),  # to be converted in the next loop
                 latex_env=env
             )
-            node = Node(name=name, statement=statement, proof=None, not_ready=source_info.notready, discussion=source_info.discussion, title=title)
+            parts.append((statement, source_info.has_refs))
+            node = Node(name=name, statement=statement, proof=None, not_ready=source_info.notready, discussion=source_info.discussion, title=environment.title)
             nodes.append(node)
             name_to_node[name] = node
 
@@ -241,46 +428,40 @@ def parse_nodes(source: str, convert_informal: bool) -> tuple[list[Node], dict[s
             label_to_node[source_info.label] = node
 
     # Parse all proof statements
-    for i, match in enumerate(ENV_PATTERN.finditer(source)):
-        env, title, content = match.groups()
-
-        if env != "proof":
-            continue
-        # Skip if match is commented out
-        if "%" in source[:match.span()[0]].split("\n")[-1].strip():
+    for i, environment in proof_environments:
+        # Skip if environment is commented out
+        if is_commented_out(source, environment.start):
             continue
 
-        source_info, node_source = process_source(content)
+        source_info, node_source = process_source(environment.content)
         proves = source_info.proves
         if proves is not None:  # manually specified \proves in plastexdepgraph
             proved = label_to_node[proves]
         else:
-            if i - 1 in match_idx_to_node:
-                proved = match_idx_to_node[i - 1]
-                if proved is None:  # informal-only node, ignore
-                    continue
-            else:
+            proved = match_idx_to_node[i - 1] if i > 0 else False
+            if proved is None:  # informal-only node, ignore
+                continue
+            if proved is False:
                 logger.warning(f"Cannot determine the statement proved by: {node_source}")
                 continue
 
         proved.proof = NodePart(
             lean_ok=source_info.leanok, text=node_source,
             uses=set(), uses_raw=set(source_info.uses),  # to be converted in the next loop
-            latex_env=env
+            latex_env=environment.env
         )
-        name_to_raw_sources[proved.name].append(match.group(0))
+        parts.append((proved.proof, source_info.has_refs))
+        name_to_raw_sources[proved.name].append(source[environment.start:environment.end])
 
     # Convert node \label to node.name
-    for node in nodes:
-        convert_latex_label_to_lean_name(node.statement, label_to_node)
-        if node.proof is not None:
-            convert_latex_label_to_lean_name(node.proof, label_to_node)
+    label_to_name = {label: node.name for label, node in label_to_node.items()}
+    for node_part, has_refs in parts:
+        convert_latex_label_to_lean_name(node_part, label_to_name, has_refs)
 
     return nodes, name_to_raw_sources, label_to_node
 
 
 def get_bibliography_files(source: str) -> list[Path]:
     """Get the bibliography from the document."""
-    bibs, _ = find_and_remove_command_arguments("bibliography", source)
-    bibs = [Path(bib + ".bib") for bib in bibs]
+    bibs = [Path(bib + ".bib") for m in _BIBLIOGRAPHY_RE.findall(source) for bib in _COMMA_SPLIT_RE.split(m.strip()) if bib]
     return bibs
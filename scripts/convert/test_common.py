@@ -0,0 +1,24 @@
+"""Tests for common.py; run with `python -m unittest` from this directory."""
+
+import unittest
+
+from common import postprocess_markdown
+
+
+class PostprocessMarkdownTest(unittest.TestCase):
+    def test_ref(self):
+        self.assertEqual(postprocess_markdown(r"See [\[sec\]](#sec)."), r"See \ref{sec}.")
+
+    def test_cite(self):
+        self.assertEqual(postprocess_markdown("[@a; @b]"), "[a] [b]")
+
+    def test_ref_in_cite(self):
+        # From \cite[see \ref{sec}]{key}
+        self.assertEqual(postprocess_markdown(r"[@key, see [\[sec\]](#sec)]"), r"[key,], see \ref{sec}")
+
+    def test_end(self):
+        self.assertEqual(postprocess_markdown("x\n\n  \\end{proof}"), "x\n\\end{proof}")
+
+
+if __name__ == "__main__":
+    unittest.main()
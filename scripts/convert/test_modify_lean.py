@@ -0,0 +1,52 @@
+"""Tests for modify_lean.py; run with `python -m unittest` from this directory."""
+
+from pathlib import Path
+import tempfile
+import unittest
+
+from common import NodeWithPos
+from modify_lean import write_blueprint_attributes
+
+
+def make_node(name: str, file: Path, pos: tuple[int, int], end_pos: tuple[int, int]) -> NodeWithPos:
+    return NodeWithPos.model_validate({
+        "name": name,
+        "statement": {"leanOk": True, "text": f"{name} text", "uses": [], "usesRaw": [], "latexEnv": "theorem"},
+        "proof": None, "notReady": False, "discussion": None, "title": None,
+        "hasLean": True, "file": str(file),
+        "location": {
+            "module": "Example.A",
+            "range": {"pos": {"line": pos[0], "column": pos[1]}, "endPos": {"line": end_pos[0], "column": end_pos[1]}},
+        },
+    })
+
+
+class WriteBlueprintAttributesTest(unittest.TestCase):
+    def test_to_additive(self):
+        # The range of the additive declaration is the `to_additive` syntax inside the multiplicative declaration
+        line = '/-- doc -/ @[to_additive "add doc"] theorem foo_mul : 1 = 1 := rfl'
+        add_start = line.index("to_additive")
+        add_end = line.index("]")
+        with tempfile.TemporaryDirectory() as tmp:
+            file = Path(tmp) / "A.lean"
+            file.write_text(f"import Mathlib\n\n{line}\n")
+            nodes = [
+                make_node("foo_add", file, (3, add_start), (3, add_end)),
+                make_node("foo_mul", file, (3, 0), (3, len(line))),
+            ]
+            for order in (nodes, nodes[::-1]):
+                file.write_text(f"import Mathlib\n\n{line}\n")
+                write_blueprint_attributes(order, ["Example"], str(Path(tmp) / "Extra.lean"), False, False)
+                self.assertEqual(
+                    file.read_text(),
+                    "import Architect\n"
+                    "import Mathlib\n\n"
+                    "/--\nfoo_mul text\n\ndoc\n-/\n"
+                    '@[to_additive (attr := blueprint\n  (latexEnv := "theorem")) "add doc" /-- foo_add text -/, blueprint\n'
+                    '  (latexEnv := "theorem")]\n'
+                    "theorem foo_mul : 1 = 1 := rfl\n"
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()